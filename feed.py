@@ -0,0 +1,293 @@
+#    FrankenLog - a logging program for ham radio contests
+#    Copyright (C) 2019  Thomas Kolb (DL5TKL)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Change feed for external tools (rate displays, scoreboards, ...).
+#
+# The feed is an append-only file with one JSON object per line. Every event
+# carries a sequence number 'seq' which increases by one per event, so a
+# consumer can resume after the last sequence number it has seen. The 'feed'
+# field identifies the feed file; it changes when the file is recreated, so
+# sequence numbers are only comparable within the same feed.
+
+import os
+import json
+import time
+import uuid
+
+def _ParseEvent(line):
+    """Parse one feed line. Returns None for torn or otherwise broken lines."""
+    try:
+        event = json.loads(line)
+        event['seq']
+        return event
+    except (ValueError, TypeError, KeyError):
+        return None
+
+def LastEvent(filename):
+    """Return the last complete, valid event in the feed or None."""
+    try:
+        f = open(filename, 'rb')
+    except FileNotFoundError:
+        return None
+
+    with f:
+        f.seek(0, os.SEEK_END)
+
+        # read backwards until a complete, valid line is in the buffer
+        buf = b''
+        pos = f.tell()
+        found_end = False
+        while pos > 0:
+            step = min(4096, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+
+            if not found_end:
+                # drop the part after the last newline, the writer has not
+                # finished it (or it is empty)
+                nl = buf.rfind(b'\n')
+                if nl < 0:
+                    continue
+
+                buf = buf[:nl]
+                found_end = True
+
+            lines = buf.split(b'\n')
+
+            # the first entry may be cut off by the chunk boundary, all other
+            # ones are complete
+            complete = lines if pos == 0 else lines[1:]
+
+            for line in reversed(complete):
+                event = _ParseEvent(line)
+                if event:
+                    return event
+
+            buf = lines[0]
+
+    return None
+
+class ChangeFeed:
+    def __init__(self, filename):
+        self.filename = filename
+
+        last = LastEvent(filename)
+        if last:
+            self.seq = last['seq']
+            self.feed_id = last.get('feed') or uuid.uuid4().hex
+        else:
+            self.seq = 0
+            self.feed_id = uuid.uuid4().hex
+
+        self.f = open(filename, 'a')
+
+        # a crashed writer may have left a torn line: terminate it, so the
+        # next event starts on a line of its own
+        if self.f.tell() > 0:
+            with open(filename, 'rb') as rf:
+                rf.seek(-1, os.SEEK_END)
+                if rf.read(1) != b'\n':
+                    self.f.write("\n")
+                    self.f.flush()
+
+    def publish(self, event, **kwargs):
+        self.seq += 1
+
+        entry = {'seq': self.seq, 'feed': self.feed_id, 'event': event}
+        entry.update(kwargs)
+
+        # one write per event, so followers never see half an event for long
+        self.f.write(json.dumps(entry) + "\n")
+        self.f.flush()
+
+        return self.seq
+
+    def close(self):
+        self.f.close()
+
+def _NextEvent(f, pos):
+    """Return (offset, event) of the first valid event on a line starting at
+    or after pos. At the end of the file, event is None and offset points to
+    the start of the (possibly unfinished) last line."""
+    if pos > 0:
+        # skip the rest of the line pos points into
+        f.seek(pos - 1)
+        f.readline()
+    else:
+        f.seek(0)
+
+    while True:
+        offset = f.tell()
+        line = f.readline()
+
+        if not line.endswith(b'\n'):
+            return offset, None
+
+        event = _ParseEvent(line)
+        if event:
+            return offset, event
+
+def _SeekSequence(f, since):
+    """Position f at the start of the first line with a sequence number greater
+    than since. Sequence numbers only increase within a file, so bisect."""
+    f.seek(0, os.SEEK_END)
+    lo = 0
+    hi = f.tell()
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+        offset, event = _NextEvent(f, mid)
+        if event is None or event['seq'] > since:
+            hi = mid
+        else:
+            lo = mid + 1
+
+    offset, event = _NextEvent(f, lo)
+    f.seek(offset)
+
+def Follow(filename, since=0, feed=None, poll_interval=0.05):
+    """Yield all events with a sequence number greater than 'since'.
+
+    To resume, pass the 'seq' and 'feed' fields of the last event seen.
+    Runs forever and waits for new events at the end of the file. If the feed
+    is truncated or replaced, 'feed' does not match, or 'since' is beyond its
+    last event, a {'seq': 0, 'event': 'reset'} marker is yielded and the feed
+    is read again from the beginning."""
+    while not os.path.exists(filename):
+        time.sleep(poll_interval)
+
+    if since > 0:
+        last = LastEvent(filename)
+        if not last or since > last['seq'] or (feed and last.get('feed') != feed):
+            # not the feed the consumer followed before
+            since = 0
+            yield {'seq': 0, 'event': 'reset'}
+
+    f = open(filename, 'rb')
+    try:
+        _SeekSequence(f, since)
+        partial = b''
+
+        while True:
+            line = f.readline()
+
+            if not line:
+                try:
+                    st = os.stat(filename)
+                except FileNotFoundError:
+                    time.sleep(poll_interval)
+                    continue
+
+                if st.st_ino != os.fstat(f.fileno()).st_ino or st.st_size < f.tell():
+                    # file was replaced or truncated: start over from the beginning
+                    f.close()
+                    f = open(filename, 'rb')
+                    partial = b''
+                    since = 0
+                    yield {'seq': 0, 'event': 'reset'}
+                    continue
+
+                time.sleep(poll_interval)
+                continue
+
+            if not line.endswith(b'\n'):
+                # writer is not finished with this line yet
+                partial += line
+                continue
+
+            line = partial + line
+            partial = b''
+
+            event = _ParseEvent(line)
+            if event and event['seq'] > since:
+                since = event['seq']
+                yield event
+    finally:
+        f.close()
+
+### Test code
+
+def _follower(filename, since, feed_id, count, result):
+    lags = []
+    last = since
+    for event in Follow(filename, since, feed_id, poll_interval=0.001):
+        if event['event'] == 'reset':
+            result.put("Unerwarteter Reset des Feeds")
+            return
+        lags.append(time.time() - event['time'])
+        if event['seq'] != last + 1:
+            result.put(f"Lücke in der Sequenz: {last} -> {event['seq']}")
+            return
+        last = event['seq']
+        if len(lags) == count:
+            break
+
+    result.put(f"{count} Events, Verzögerung: Mittel {sum(lags) / len(lags) * 1000:.2f} ms, Max {max(lags) * 1000:.2f} ms")
+
+if __name__ == "__main__":
+    import tempfile
+    import multiprocessing
+
+    events = 1000
+    rate = 500 # events per second
+    followers = 3
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "feed.jsonl")
+
+        # a last event larger than one read chunk must still be found
+        feed = ChangeFeed(filename)
+        for i in range(50):
+            feed.publish('add', idx=i)
+        feed.publish('snapshot', qsos=['x' * 100] * 150)
+        feed.close()
+        assert LastEvent(filename)['seq'] == 51
+        feed = ChangeFeed(filename)
+        assert feed.publish('add') == 52
+        feed.close()
+        os.remove(filename)
+
+        # some history, so the followers have to resume in the middle
+        feed = ChangeFeed(filename)
+        for i in range(100):
+            feed.publish('add', idx=i, time=time.time())
+        feed.close()
+
+        feed = ChangeFeed(filename)
+        start_seq = feed.seq
+        print(f"Fortsetzen ab Sequenznummer {start_seq}")
+
+        result = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=_follower, args=(filename, start_seq, feed.feed_id, events, result))
+                for _ in range(followers)]
+        for p in procs:
+            p.start()
+
+        publish_times = []
+        for i in range(events):
+            t0 = time.perf_counter()
+            feed.publish('add', idx=start_seq + i, qso={'rx_call': 'DL0XX'}, time=time.time())
+            publish_times.append(time.perf_counter() - t0)
+            time.sleep(1 / rate)
+
+        for p in procs:
+            p.join()
+            print(result.get())
+
+        feed.close()
+
+        print(f"Veröffentlichen: Mittel {sum(publish_times) / events * 1e6:.1f} µs, Max {max(publish_times) * 1e6:.1f} µs")
@@ -21,13 +21,19 @@ import re
 import argparse
 import time
 import json
+import hashlib
 import readline
 
 import helper
 from helper import set_output_color
+from feed import ChangeFeed
 
 VERSION = 0.3
 
+# increase this whenever the points or multiplier rules change, so stored
+# checkpoints are no longer trusted
+EVALUATION_VERSION = 1
+
 # regular expressions for different parts of a QSO
 callregex = re.compile('([a-z0-9]+/)?[a-z]{1,2}[0-9]+[a-z]+(/p|/m|/mm|/am)?', re.IGNORECASE)
 dokregex = re.compile('nm|([0-9]+)?[a-z][0-9]{2}', re.IGNORECASE)
@@ -75,9 +81,10 @@ class QSO:
     def serialize(self):
         return json.dumps(self.data)
 
-    def deserialize(self, string):
+    def deserialize(self, string, recompute=True):
         self.data = json.loads(string)
-        self.update_stats()
+        if recompute:
+            self.update_stats()
 
     def edit(self):
         cmd = 'x'
@@ -126,16 +133,30 @@ class QSO:
         self.update_stats()
 
     def update_stats(self):
+        # stays False if the calculation below raises, so outdated stats are
+        # never written to a checkpoint
+        self.stats = None
+        self.stats_valid = False
+
         tx_loc = self.my_info['loc']
         rx_loc = self.data['rx_loc']
 
         if not tx_loc or not rx_loc:
-            self.stats = None
+            self.stats_valid = True
             return
 
-        self.stats = {}
-        self.stats['distance'] = helper.DistanceBetweenLocs(tx_loc, rx_loc)
-        self.stats['dok']    = self.data['rx_dok']
+        stats = {}
+        stats['distance'] = helper.DistanceBetweenLocs(tx_loc, rx_loc)
+        stats['dok']    = self.data['rx_dok']
+
+        # QSOs within the own DOK do not give any points
+        if self.my_info['dok'] != self.data['rx_dok']:
+            stats['points'] = round(stats['distance'])
+        else:
+            stats['points'] = 0
+
+        self.stats = stats
+        self.stats_valid = True
 
     def print_table_header(self, term=True):
         print("QSO# ", end='')
@@ -169,38 +190,105 @@ class QSO:
 
 
 class QSOManager:
-    def __init__(self, my_info, log_file):
+    def __init__(self, my_info, log_file, feed_file=None):
         self.my_info = my_info
 
         self.log_file = log_file
 
+        self.feed = ChangeFeed(feed_file) if feed_file else None
+
         self.qsos = []
         self.compo = None
 
+        # evaluation state, kept up to date on every change
+        self.seen_doks = set()
+        self.dok_multis = []
+        self.total_points = 0
+
         if os.path.exists(log_file):
             self.load(log_file)
 
             set_output_color("blue")
             print(f"{len(self.qsos)} QSOs geladen.")
 
+        if self.feed:
+            # the log may have changed while the feed was not written (or the
+            # feed was used with another log), so always start with the full state
+            self.publish_snapshot()
+
     def load(self, log_file):
+        checkpoint = None
+        lines = []
+
         with open(log_file, 'r') as f:
             firstLine = True
             for line in f:
+                line = line.rstrip('\n')
+                if not line:
+                    continue
+
                 if firstLine:
                     firstLine = False
 
                     obj = json.loads(line)
                     if 'class' in obj:
                         self.compo = obj['class']
+                        checkpoint = obj.get('checkpoint')
                         continue # successfully parsed, so this line is not a QSO
                     else:
                         self.compo = None
 
+                lines.append(line)
+
+        if self.checkpoint_valid(checkpoint, lines):
+            # nothing changed since the last save: take all derived data from
+            # the checkpoint instead of recomputing it
+            for line, stats in zip(lines, checkpoint['stats']):
+                q = QSO(self.my_info)
+                q.deserialize(line, recompute=False)
+                q.stats = stats
+                q.stats_valid = True
+                self.qsos.append(q)
+
+            self.seen_doks = set(checkpoint['doks'])
+            self.dok_multis = checkpoint['multis']
+            self.total_points = checkpoint['points']
+        else:
+            for line in lines:
                 q = QSO(self.my_info)
                 q.deserialize(line)
                 self.qsos.append(q)
 
+            self.update_evaluation()
+
+    def content_hash(self, lines):
+        h = hashlib.sha256()
+        for line in lines:
+            h.update(line.encode('utf-8'))
+            h.update(b"\n")
+
+        return h.hexdigest()
+
+    def rules_hash(self):
+        """Hash over everything in the code the evaluation depends on."""
+        rules = {'version': EVALUATION_VERSION, 'doks': helper.DOK_LIST}
+        return hashlib.sha256(json.dumps(rules).encode('utf-8')).hexdigest()
+
+    def checkpoint_valid(self, checkpoint, lines):
+        """Check whether the checkpoint matches the station info, the rules and the QSOs."""
+        if not checkpoint:
+            return False
+
+        try:
+            return checkpoint['loc'] == self.my_info['loc'] \
+                    and checkpoint['dok'] == self.my_info['dok'] \
+                    and checkpoint['rules'] == self.rules_hash() \
+                    and checkpoint['hash'] == self.content_hash(lines) \
+                    and len(checkpoint['stats']) == len(lines) \
+                    and len(checkpoint['multis']) == len(lines)
+        except (KeyError, TypeError):
+            return False
+
     def save(self, log_file=None):
         if not log_file:
             log_file = self.log_file
@@ -208,12 +296,75 @@ class QSOManager:
         if os.path.exists(log_file):
             os.rename(log_file, log_file + "~")
 
+        lines = [qso.serialize() for qso in self.qsos]
+
+        checkpoint = None
+        if all(qso.stats_valid for qso in self.qsos):
+            checkpoint = {
+                    'loc': self.my_info['loc'],
+                    'dok': self.my_info['dok'],
+                    'rules': self.rules_hash(),
+                    'hash': self.content_hash(lines),
+                    'stats': [qso.stats for qso in self.qsos],
+                    'multis': self.dok_multis,
+                    'doks': sorted(self.seen_doks),
+                    'points': self.total_points
+                }
+
         with open(log_file, 'w') as f:
-            meta = {'class': self.compo}
+            meta = {'class': self.compo, 'checkpoint': checkpoint}
             f.write(json.dumps(meta) + "\n")
 
-            for qso in self.qsos:
-                f.write(qso.serialize() + "\n")
+            for line in lines:
+                f.write(line + "\n")
+
+    def publish_change(self, event, qsoidx):
+        """Send an add/edit event for the given QSO to the change feed."""
+        if not self.feed:
+            return
+
+        q = self.qsos[qsoidx]
+
+        self.feed.publish(event,
+                time=time.time(),
+                idx=qsoidx,
+                qso=q.data,
+                stats=q.stats,
+                score=self.score())
+
+    def publish_snapshot(self):
+        """Send the complete log to the change feed as a single event."""
+        self.feed.publish('snapshot',
+                time=time.time(),
+                qsos=[q.data for q in self.qsos],
+                stats=[q.stats for q in self.qsos],
+                score=self.score())
+
+    def score(self):
+        multi = len(self.seen_doks)
+        return {'points': self.total_points, 'multi': multi, 'total': multi * self.total_points}
+
+    def evaluate_qso(self, q):
+        """Add a single QSO to the evaluation state."""
+        if q.stats:
+            self.total_points += q.stats['points']
+
+        dok = q.data['rx_dok']
+        dok_multi = dok not in self.seen_doks and helper.DOKCountsAsMulti(dok)
+
+        if dok_multi:
+            self.seen_doks.add(dok)
+
+        self.dok_multis.append(dok_multi)
+
+    def update_evaluation(self):
+        """Rebuild the evaluation state from the per-QSO stats."""
+        self.seen_doks = set()
+        self.dok_multis = []
+        self.total_points = 0
+
+        for q in self.qsos:
+            self.evaluate_qso(q)
 
     def add_qso_from_string(self, text):
         parts = text.split(' ')
@@ -268,6 +419,7 @@ class QSOManager:
 
         qsoidx = len(self.qsos)
         self.qsos.append(q)
+        self.evaluate_qso(q)
 
         return q, qsoidx
 
@@ -277,7 +429,12 @@ class QSOManager:
             print("Keine QSOs im Log.")
             return
 
-        self.qsos[-1].edit()
+        try:
+            self.qsos[-1].edit()
+        finally:
+            self.update_evaluation()
+
+        return len(self.qsos) - 1
 
     def print_qso_table(self):
         if not self.qsos:
@@ -296,11 +453,6 @@ class QSOManager:
             print("Keine QSOs im Log.")
             return
 
-        total_points = 0
-        multi = 0
-
-        seen_doks = set()
-
         self.qsos[0].print_table_header(term=False)
         print("Punkte ", end='')
         print("DOK-Multi ", end='')
@@ -309,17 +461,8 @@ class QSOManager:
         for i in range(len(self.qsos)):
             q = self.qsos[i]
 
-            points = 0
-            if self.my_info['dok'] != q.data['rx_dok']:
-                points = round(q.stats['distance'])
-
-            total_points += points
-
-            dok_multi = q.stats['dok'] not in seen_doks and helper.DOKCountsAsMulti(q.stats['dok'])
-
-            if dok_multi:
-                seen_doks.add(q.stats['dok'])
-                multi += 1
+            points = q.stats['points'] if q.stats else 0
+            dok_multi = self.dok_multis[i]
 
             if points > 1000:
                 set_output_color("red")
@@ -333,8 +476,9 @@ class QSOManager:
 
             set_output_color("default")
 
-        score = multi * total_points
-        print(f"\nGesamtpunktzahl = Multi × Punkte = {multi} × {total_points} = {score}\n")
+        multi = len(self.seen_doks)
+        score = multi * self.total_points
+        print(f"\nGesamtpunktzahl = Multi × Punkte = {multi} × {self.total_points} = {score}\n")
 
         print("QSOs \033[0;33m>300km\033[0m oder \033[0;31m>1000km\033[0m sollten besonders auf Fehler geprüft werden!\n")
 
@@ -498,10 +642,14 @@ class QSOManager:
                 print("")
             elif cmd == 'q':
                 self.save()
+                if self.feed:
+                    self.feed.close()
                 break
             elif cmd == 'e':
-                self.edit_last_qso()
+                qsoidx = self.edit_last_qso()
                 self.save()
+                if qsoidx is not None:
+                    self.publish_change('edit', qsoidx)
             elif cmd == 'b':
                 nstr = input('QSO-Nummer> ')
                 set_output_color("red")
@@ -511,8 +659,16 @@ class QSOManager:
                 else:
                     try:
                         qsoidx = int(nstr)
-                        self.qsos[qsoidx].edit()
+                        if qsoidx < 0:
+                            # the feed needs the real index, not Python's negative one
+                            qsoidx += len(self.qsos)
+
+                        try:
+                            self.qsos[qsoidx].edit()
+                        finally:
+                            self.update_evaluation()
                         self.save()
+                        self.publish_change('edit', qsoidx)
                     except Exception as e:
                         print(f"Fehler bei der QSO-Bearbeitung: {str(e)}")
 
@@ -535,6 +691,7 @@ class QSOManager:
             elif len(cmd) > 1:
                 q, qsoidx = self.add_qso_from_string(cmd)
                 self.save()
+                self.publish_change('add', qsoidx)
 
                 set_output_color("cyan")
 
@@ -593,6 +750,7 @@ def get_user_info(info_file_name):
 
 parser = argparse.ArgumentParser(description='Logprogramm für die Frankenaktivität.')
 parser.add_argument('-o', '--output-file', dest='output_file', type=str, required=True, help='In dieser Datei werden die QSOs gespeichert. Wird beim Start eingelesen.')
+parser.add_argument('-f', '--feed-file', dest='feed_file', type=str, default=None, help='Optionale Datei, an die jede Änderung am Log als Ereignis mit Sequenznummer angehängt wird (für externe Anzeigen).')
 parser.add_argument('-i', '--info-file', dest='info_file', type=str, required=True, help='Datei mit Benutzerinformationen. Wird angelegt, wenn sie nicht existiert. Fehlende Infos werden abgefragt.')
 
 args = parser.parse_args()
@@ -615,6 +773,6 @@ Gib 'h' für eine Befehlsliste ein.
 
 set_output_color("default")
 
-qsomgr = QSOManager(my_info, args.output_file)
+qsomgr = QSOManager(my_info, args.output_file, args.feed_file)
 
 qsomgr.loop()